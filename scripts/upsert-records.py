@@ -1,12 +1,48 @@
 #!/usr/bin/env python3
 
-import copy
+import collections
+import contextlib
+import importlib
+import itertools
 import json
 import os
+from operator import itemgetter
 import requests
+import requests.adapters
 import sys
 
 
+# Keys allowed in items of an item_list, see make_rrset
+CONTENT_ITEM_KEYS = frozenset(["c", "r"])
+TTL_ITEM_KEYS = frozenset(["t"])
+
+# Parts of heritage records, see get_owned_keys_from_rrsets
+HERITAGE_NAME_PREFIX = "_ansible-pdns-api."
+HERITAGE_NAME_PREFIX_LEN = len(HERITAGE_NAME_PREFIX)
+HERITAGE_RECORD_PREFIX = '"heritage=ansible-pdns-api,type='
+HERITAGE_RECORD_PREFIX_LEN = len(HERITAGE_RECORD_PREFIX)
+HERITAGE_RECORD_SUFFIX = '"'
+HERITAGE_RECORD_SUFFIX_LEN = len(HERITAGE_RECORD_SUFFIX)
+
+
+def import_ijson_c_backend():
+    """
+    Returns the fastest available ijson backend that is based on the yajl C
+    library, or None if there is none.
+    Older ijson versions default to their pure-Python backend, which is much
+    slower than a buffered parse with the json module.
+    """
+    for backend in ["yajl2_c", "yajl2_cffi", "yajl2"]:
+        try:
+            return importlib.import_module("ijson.backends." + backend)
+        except ImportError:
+            pass
+    return None
+
+
+IJSON_BACKEND = import_ijson_c_backend()
+
+
 def main():
     """
     Reads records for a single zone from an input file and synchronizes the
@@ -38,115 +74,167 @@ def main():
     arg_zone_id = sys.argv[4]
     arg_api_key = os.environ["PDNS_AUTH_API_KEY"]
 
-    zone = load_json_from_filepath(arg_varfile)["pdns_auth_api_zones"][arg_zone_id]
+    zone = load_zone_from_filepath(arg_varfile, arg_zone_id)
+    zone_fqdn = arg_zone_id + "."
+    zone_url = "{}/api/v1/servers/{}/zones/{}".format(arg_server_location, arg_server_id, zone_fqdn)
+
+    session = make_session(arg_api_key)
 
-    remote_rrsets = http_get_rrsets(arg_server_location, arg_server_id, arg_zone_id, arg_api_key)
+    remote_rrsets = http_get_rrsets(session, zone_url)
 
     target_rrsets = add_heritage_records(
         patch_soa(
             make_rrsets(zone["records"], zone["defaultTTL"]),
             remote_rrsets,
-            arg_zone_id,
+            zone_fqdn,
         ),
         zone["defaultTTL"],
     )
 
     owned_keys = get_owned_keys_from_rrsets(remote_rrsets)
 
-    conflicting_rrset_list = [ (key, rrset) for key, rrset in target_rrsets.items() if key in remote_rrsets and key not in owned_keys and key[1] not in ["NS", "SOA"] ]
+    remote_digests = { (key, rrset_digest(rrset)) for key, rrset in remote_rrsets.items() }
+
+    # Classify each target RRset as either conflicting or to be replaced
+    conflicting_rrset_list = []
+    replace_patches = []
+    for key, rrset in target_rrsets.items():
+        if key in remote_rrsets and key not in owned_keys and key[1] not in ["NS", "SOA"]:
+            conflicting_rrset_list.append((key, rrset))
+        elif (key, rrset_digest(rrset)) not in remote_digests:
+            replace_patches.append({
+                **rrset,
+                "changetype": "REPLACE",
+            })
+
     if len(conflicting_rrset_list) != 0:
+        lines = []
         for key, rrset in conflicting_rrset_list:
-            for record in rrset["records"]:
-                print(
-                    "Could not write record: {} {} {}"
-                    .format(rrset["name"], rrset["type"], record["content"]),
-                    file=sys.stderr,
-                )
-            for record in remote_rrsets[key]["records"]:
-                print(
-                    " Hint: Would overwrite: {} {} {}"
-                    .format(rrset["name"], rrset["type"], record["content"]),
-                    file=sys.stderr,
-                )
+            lines.extend(
+                "Could not write record: {} {} {}"
+                .format(rrset["name"], rrset["type"], record["content"])
+                for record in rrset["records"]
+            )
+            lines.extend(
+                " Hint: Would overwrite: {} {} {}"
+                .format(rrset["name"], rrset["type"], record["content"])
+                for record in remote_rrsets[key]["records"]
+            )
+        sys.stderr.write("\n".join(lines) + "\n")
         raise ValueError("Attempted to overwrite foreign-owned record(s)")
 
+    delete_keys = owned_keys & (remote_rrsets.keys() - target_rrsets.keys())
     rrset_patches = [
         {
-            "name": rrset["name"],
-            "type": rrset["type"],
+            "name": remote_rrsets[key]["name"],
+            "type": remote_rrsets[key]["type"],
             "changetype": "DELETE",
         }
-        for key, rrset in remote_rrsets.items() if key in owned_keys and key not in target_rrsets
-    ] + [
-        {
-            **rrset,
-            "changetype": "REPLACE",
-        }
-        for key, rrset in target_rrsets.items() if normalized_rrset(rrset) not in remote_rrsets.values()
-    ]
-
+        for key in sorted(delete_keys)
+    ] + replace_patches
+
+    rrset_patches_json = json.dumps(rrset_patches, separators=(",", ":"))
+    # An AUTO serial has been replaced by the remote serial in patch_soa, so
+    # the SOA RRset only shows up here if something other than its serial
+    # changed. This does not hold for every RRset: PowerDNS never returns
+    # "set-ptr", so RRsets with "r" items are replaced on every run.
     if len(rrset_patches) != 0:
-        http_patch_rrsets(arg_server_location, arg_server_id, arg_zone_id, arg_api_key, rrset_patches)
+        http_patch_rrsets(session, zone_url, rrset_patches_json)
 
-    print(json.dumps(rrset_patches))
+    print(rrset_patches_json)
 
 
-def load_json_from_filepath(filepath):
+def load_zone_from_filepath(filepath, zone_id):
     """
-    Loads JSON from the file at filepath.
+    Loads a single zone from the "pdns_auth_api_zones" dict in the JSON file at
+    filepath.
+    If a yajl-based ijson backend is available, the file is parsed
+    incrementally, so only the requested zone is kept in memory.
+
+    Parameters
+    ----------
+    filepath : str
+        See VARFILE argument to this script.
+    zone_id : str
+        See ZONE_ID argument to this script.
     """
-    with open(filepath) as f:
-        return json.load(f)
+    if IJSON_BACKEND is None:
+        with open(filepath) as f:
+            return json.load(f)["pdns_auth_api_zones"][zone_id]
+    with open(filepath, "rb") as f:
+        for zone in IJSON_BACKEND.items(f, "pdns_auth_api_zones.{}".format(zone_id)):
+            return zone
+    raise KeyError(zone_id)
 
 
-def http_get_rrsets(server_location, server_id, zone_id, api_key):
+def make_session(api_key):
     """
-    Gets the list of RRsets of a certain zone from a remote PowerDNS Server.
+    Creates an HTTP session that sends the X-API-Key header with every request
+    and keeps the connection to the PowerDNS API alive between requests.
+    The webserver of PowerDNS only speaks HTTP/1.1, and the PATCH depends on
+    the result of the GET, so a single persistent connection is all that can
+    be shared between them.
 
     Parameters
     ----------
-    server_location : str
-        See SERVER_LOCATION argument to this script.
-    server_id : str
-        See SERVER_ID argument to this script.
-    zone_id : str
-        See ZONE_ID argument to this script.
     api_key : str
         The API key for the X-API-Key header.
     """
-    url = "{}/api/v1/servers/{}/zones/{}.".format(server_location, server_id, zone_id)
-    headers = {"X-API-Key": api_key}
-    print("GET {}".format(url), file=sys.stderr)
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    rrset_list = response.json()["rrsets"]
-    return index_rrsets([ normalized_rrset(rrset) for rrset in rrset_list ])
+    session = requests.Session()
+    session.headers.update({"X-API-Key": api_key})
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
-def http_patch_rrsets(server_location, server_id, zone_id, api_key, rrset_patches):
+def http_get_rrsets(session, zone_url):
+    """
+    Gets the list of RRsets of a certain zone from a remote PowerDNS Server.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session created by make_session.
+    zone_url : str
+        URL of the zone in the PowerDNS API.
+    """
+    print("GET {}".format(zone_url), file=sys.stderr)
+    response = session.get(zone_url, params={"dnssec": "false", "rrsets": "true"}, stream=True)
+    # Release the connection to the session once the body has been parsed
+    with contextlib.closing(response):
+        response.raise_for_status()
+        if IJSON_BACKEND is not None:
+            # Parse the RRsets one by one while the body is being received
+            response.raw.decode_content = True
+            rrsets = IJSON_BACKEND.items(response.raw, "rrsets.item")
+        else:
+            rrsets = response.json()["rrsets"]
+        return index_rrsets(normalized_rrset(rrset) for rrset in rrsets)
+
+
+def http_patch_rrsets(session, zone_url, rrset_patches_json):
     """
     Patches the list of RRsets of a certain zone on a remote PowerDNS Server.
 
     Parameters
     ----------
-    server_location : str
-        See SERVER_LOCATION argument to this script.
-    server_id : str
-        See SERVER_ID argument to this script.
-    zone_id : str
-        See ZONE_ID argument to this script.
-    api_key : str
-        The API key for the X-API-Key header.
-    rrset_patches : list of dict
-        List of RRsets where each RRset has the following form:
+    session : requests.Session
+        Session created by make_session.
+    zone_url : str
+        URL of the zone in the PowerDNS API.
+    rrset_patches_json : str
+        JSON-encoded list of RRsets where each RRset has the following form:
         https://doc.powerdns.com/authoritative/http-api/zone.html#rrset
     """
-    url = "{}/api/v1/servers/{}/zones/{}.".format(server_location, server_id, zone_id)
-    headers = {"X-API-Key": api_key}
-    print("PATCH {}".format(url), file=sys.stderr)
-    body = json.dumps({"rrsets": rrset_patches})
+    print("PATCH {}".format(zone_url), file=sys.stderr)
+    body = '{"rrsets":' + rrset_patches_json + '}'
     try:
-        requests.patch(url, headers=headers, data=body).raise_for_status()
+        session.patch(
+            zone_url,
+            data=body.encode(),
+            headers={"Content-Type": "application/json"},
+        ).raise_for_status()
     except:
         print("Request body was:", file=sys.stderr)
         print(body, file=sys.stderr)
@@ -155,20 +243,35 @@ def http_patch_rrsets(server_location, server_id, zone_id, api_key, rrset_patche
 
 def normalized_rrset(rrset):
     """
-    Returns a copy of the given RRset with comments removed and records sorted.
+    Removes the comments from the given RRset, sorts its records in place and
+    returns it.
     """
-    normalized = copy.copy(rrset)
-    if "comments" in rrset:
-        del normalized["comments"]
-    if "records" in normalized:
-        normalized["records"].sort(key=lambda record: record["content"])
-    return normalized
+    rrset.pop("comments", None)
+    if "records" in rrset:
+        rrset["records"].sort(key=itemgetter("content"))
+    return rrset
+
+
+def rrset_digest(rrset):
+    """
+    Returns a hashable representation of the TTL and records of the given
+    RRset.
+    Two RRsets with the same name and type are equal if their digests are
+    equal, regardless of the order of their records.
+    """
+    return (
+        rrset["ttl"],
+        tuple(sorted(
+            (record["content"], record["disabled"], record.get("set-ptr", False))
+            for record in rrset["records"]
+        )),
+    )
 
 
 def make_rrsets(records, default_ttl):
     """
-    Converts a dict of records into a list of RRsets as understood by the
-    PowerDNS API, and returns that list.
+    Converts a dict of records into RRsets as understood by the PowerDNS API,
+    and returns them as a dict indexed by name and type.
 
     Parameters
     ----------
@@ -178,11 +281,11 @@ def make_rrsets(records, default_ttl):
         Default TTL to use for RRsets where none is specified in the dict of
         records.
     """
-    rrset_list = []
-    for domain, records_by_type in records.items():
-        for record_type, item_list in records_by_type.items():
-            rrset_list.append(make_rrset(domain, record_type, item_list, default_ttl))
-    return index_rrsets(rrset_list)
+    return index_rrsets(
+        make_rrset(domain, record_type, item_list, default_ttl)
+        for domain, records_by_type in records.items()
+        for record_type, item_list in records_by_type.items()
+    )
 
 
 def make_rrset(domain, record_type, item_list, default_ttl):
@@ -205,10 +308,9 @@ def make_rrset(domain, record_type, item_list, default_ttl):
     ttl_from_item_list = None
     for item in item_list:
         if "c" in item:
-            illegal_keys = [key for key in item.keys() if key not in ['c', 'r']]
-            if len(illegal_keys) != 0:
-                for key in illegal_keys:
-                    print("Illegal key: {}".format(key), file=sys.stderr)
+            illegal_keys = item.keys() - CONTENT_ITEM_KEYS
+            if illegal_keys:
+                sys.stderr.write("\n".join("Illegal key: {}".format(key) for key in sorted(illegal_keys)) + "\n")
                 raise ValueError("Illegal key(s) in item for RRset '{} {}'".format(name, record_type))
             record = {
                 "content": item["c"],
@@ -217,10 +319,9 @@ def make_rrset(domain, record_type, item_list, default_ttl):
             }
             records.append(record)
         elif "t" in item:
-            illegal_keys = [key for key in item.keys() if key not in ['t']]
-            if len(illegal_keys) != 0:
-                for key in illegal_keys:
-                    print("Illegal key: {}".format(key), file=sys.stderr)
+            illegal_keys = item.keys() - TTL_ITEM_KEYS
+            if illegal_keys:
+                sys.stderr.write("\n".join("Illegal key: {}".format(key) for key in sorted(illegal_keys)) + "\n")
                 raise ValueError("Illegal key(s) in item for RRset '{} {}'".format(name, record_type))
             if ttl_from_item_list is not None:
                 raise ValueError("Duplicate TTL for RRset '{} {}'".format(name, record_type))
@@ -235,15 +336,18 @@ def make_rrset(domain, record_type, item_list, default_ttl):
 
 def index_rrsets(rrset_list):
     """
-    Converts a list of RRsets into a dict of RRsets, indexed by name and type.
+    Converts an iterable of RRsets into a dict of RRsets, indexed by name and
+    type.
     """
     return { (rrset["name"], rrset["type"]): rrset for rrset in rrset_list } # map comprehension
 
 
-def patch_soa(dst_rrsets, src_rrsets, zone_id):
+def patch_soa(dst_rrsets, src_rrsets, zone_fqdn):
     """
     Takes two dicts of RRsets where each dict must contain an SOA record, and
-    returns a copy of the first dict.
+    returns a shallow copy of the first dict.
+    Only the SOA RRset of the copy is replaced; all other RRsets are shared
+    with the first dict.
     If the first SOA record has "AUTO" as its serial, then the serial from
     the second SOA record is injected into the returned dict.
 
@@ -254,23 +358,27 @@ def patch_soa(dst_rrsets, src_rrsets, zone_id):
     src_rrsets : dict
         Dict of RRsets that's only used in order to read the serial of the SOA
         record, if required.
-    zone_id : str
-        Domain of the SOA record.
+    zone_fqdn : str
+        Domain of the SOA record, with trailing dot.
     """
-    dst_soa = extract_soa(dst_rrsets, zone_id)
-    src_soa = extract_soa(src_rrsets, zone_id)
-    tokens = dst_soa.split(" ")
+    dst_soa = extract_soa(dst_rrsets, zone_fqdn)
+    src_soa = extract_soa(src_rrsets, zone_fqdn)
+    # Only the serial (third token) may need to be replaced
+    tokens = dst_soa.split(" ", 3)
     if tokens[2] == "AUTO":
-        tokens[2] = src_soa.split(" ")[2]
+        tokens[2] = src_soa.split(" ", 3)[2]
     result_soa = " ".join(tokens)
-    result_rrsets = copy.deepcopy(dst_rrsets)
-    for rrset in result_rrsets.values():
-        if rrset["type"] == "SOA":
-            rrset["records"][0]["content"] = result_soa
+    soa_key = (zone_fqdn, "SOA")
+    dst_soa_rrset = dst_rrsets[soa_key]
+    result_rrsets = dict(dst_rrsets)
+    result_rrsets[soa_key] = {
+        **dst_soa_rrset,
+        "records": [{**dst_soa_rrset["records"][0], "content": result_soa}],
+    }
     return result_rrsets
 
 
-def extract_soa(rrsets, zone_id):
+def extract_soa(rrsets, zone_fqdn):
     """
     Takes a dict of RRsets which must contain a SOA record, and returns its SOA
     record.
@@ -279,13 +387,12 @@ def extract_soa(rrsets, zone_id):
     ----------
     rrsets : dict
         Dict of RRsets.
-    zone_id : str
-        Domain of the SOA record.
+    zone_fqdn : str
+        Domain of the SOA record, with trailing dot.
     """
-    name = zone_id + "."
-    if (name, "SOA") not in rrsets:
+    if (zone_fqdn, "SOA") not in rrsets:
         raise ValueError("Zone has no SOA RRset")
-    rrset = rrsets[(name, "SOA")]
+    rrset = rrsets[(zone_fqdn, "SOA")]
     if len(rrset["records"]) < 1:
         raise ValueError("Zone has SOA RRset with zero records")
     if len(rrset["records"]) > 1:
@@ -302,42 +409,36 @@ def get_owned_keys_from_rrsets(rrsets):
 
     _ansible-pdns-api.<name> TXT "heritage=ansible-pdns-api,type=<type>"
     """
-    owned_keys = set()
-    for rrset in rrsets.values():
-        if rrset["type"] == "TXT":
-            owned_keys.update(get_owned_keys_from_rrset(rrset))
-    return owned_keys
+    return set(itertools.chain.from_iterable(
+        get_owned_keys_from_rrset(rrset) for rrset in rrsets.values() if rrset["type"] == "TXT"
+    ))
 
 
 def get_owned_keys_from_rrset(rrset):
     """
-    Given an RRset of type TXT, returns the key for which it indicates
+    Given an RRset of type TXT, yields the keys for which it indicates
     ownership.
     See get_owned_keys_from_rrsets for more information.
     """
     if rrset["type"] != "TXT":
         raise ValueError("Can not read heritage from RRset of type {}, must be type TXT".format(rrset["type"]))
     # Get name
-    name_prefix = "_ansible-pdns-api."
-    if not rrset["name"].startswith(name_prefix):
-        return set()
+    if not rrset["name"].startswith(HERITAGE_NAME_PREFIX):
+        return
     # Own the heritage record itself:
-    owned_keys = { (rrset["name"], "TXT") }
+    yield (rrset["name"], "TXT")
     # Own the keys referenced by the heritage record:
-    name = rrset["name"][len(name_prefix):]
-    record_prefix = '"heritage=ansible-pdns-api,type='
-    record_suffix = '"'
+    name = rrset["name"][HERITAGE_NAME_PREFIX_LEN:]
     for record in rrset["records"]:
-        if not record["content"].startswith(record_prefix) or not record["content"].startswith(record_suffix):
+        if not record["content"].startswith(HERITAGE_RECORD_PREFIX) or not record["content"].endswith(HERITAGE_RECORD_SUFFIX):
             print(
                 "WARNING: Malformed heritage record: {} {} {}"
                 .format(rrset["name"], rrset["type"], record["content"]),
                 file=sys.stderr,
             )
         else:
-            owned_type = record["content"][len(record_prefix):-len(record_suffix)]
-            owned_keys.add((name, owned_type))
-    return owned_keys
+            owned_type = record["content"][HERITAGE_RECORD_PREFIX_LEN:-HERITAGE_RECORD_SUFFIX_LEN]
+            yield (name, owned_type)
 
 
 def add_heritage_records(rrsets, default_ttl):
@@ -356,21 +457,30 @@ def add_heritage_records(rrsets, default_ttl):
     default_ttl : int
         TTL to use for the heritage records.
     """
-    extended_rrsets = copy.copy(rrsets)
+    owned_types_by_name = collections.defaultdict(list)
     for rrset in rrsets.values():
-        heritage_name = "_ansible-pdns-api.{}".format(rrset["name"])
+        owned_types_by_name[HERITAGE_NAME_PREFIX + rrset["name"]].append(rrset["type"])
+    extended_rrsets = dict(rrsets)
+    for heritage_name, owned_types in owned_types_by_name.items():
         key = (heritage_name, "TXT")
-        if key not in extended_rrsets:
-            extended_rrsets[key] = {
+        if key in rrsets:
+            # Keep the records of a TXT RRset that is already present
+            heritage_rrset = {**rrsets[key], "records": list(rrsets[key]["records"])}
+        else:
+            heritage_rrset = {
                 "name": heritage_name,
                 "type": "TXT",
                 "records": [],
                 "ttl": default_ttl,
             }
-        extended_rrsets[key]["records"].append({
-            "content": '"heritage=ansible-pdns-api,type={}"'.format(rrset["type"]),
-            "disabled": False,
-        })
+        heritage_rrset["records"].extend(
+            {
+                "content": HERITAGE_RECORD_PREFIX + owned_type + HERITAGE_RECORD_SUFFIX,
+                "disabled": False,
+            }
+            for owned_type in owned_types
+        )
+        extended_rrsets[key] = heritage_rrset
     return extended_rrsets
 
 